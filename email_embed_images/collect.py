@@ -4,31 +4,76 @@ import logging
 import mimetypes
 import os
 import re
+import time
 from typing import Dict, Iterable, List, Optional, Tuple, Union
 
 import requests
 from lxml import etree
 
+# Signatures of the first bytes of the content: (offset, signature, mime type).
+MAGIC_SIGNATURES = (
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (8, b"WEBP", "image/webp"),
+    (0, b"%PDF-", "application/pdf"),
+)  # type: Tuple[Tuple[int, bytes, str], ...]
+
+# Content types that do not say anything about the content.
+GENERIC_CONTENT_TYPES = ("application/octet-stream", "binary/octet-stream")
+# Prefix of the cache key for HTTP Content-Type of the url.
+CONTENT_TYPE_KEY = "content-type:"
+# Size of chunks of downloaded files. The budget is checked after each chunk.
+CHUNK_SIZE = 64 * 1024
+
 
 class ImageNotFound(Exception):
     """Image not found."""
 
 
+class BudgetExceeded(ImageNotFound):
+    """Image not loaded because the time or bytes budget is exhausted."""
+
+
+def sniff_mime_type(content: bytes) -> Optional[str]:
+    """Detect mime type from the first bytes of the content."""
+    for offset, signature, ctype in MAGIC_SIGNATURES:
+        if content[offset:offset + len(signature)] == signature:
+            if ctype == "image/webp" and not content.startswith(b"RIFF"):
+                continue
+            return ctype
+    head = content[:1024].lstrip()
+    if (head.startswith(b"<svg") or head.startswith(b"<?xml")) and b"<svg" in head:
+        return "image/svg+xml"
+    return None
+
+
 class CollectImages:
     """Find links to images in HTML code and create a list of contents."""
 
     def __init__(self, cache=None, folders_root: List[str] = None,
-                 requests_timeout: Union[int, Tuple[int, int]] = None) -> None:
+                 requests_timeout: Union[int, Tuple[Optional[int], Optional[int]]] = None,
+                 time_budget: float = None, bytes_budget: int = None) -> None:
         self.pretty_print = False
         # https://requests.readthedocs.io/en/latest/user/advanced/#timeouts
         self.requests_timeout = requests_timeout
         self.cache = cache
         self.folders_root = ["."] if folders_root is None else folders_root
+        self.content_types = {}  # type: Dict[str, str]
+        # Total budgets of all loaded files: seconds and bytes.
+        self.time_budget = time_budget
+        self.bytes_budget = bytes_budget
+        self.init_budget()
 
     def log_error(self, error: Exception) -> None:
         """Log error, then raise if is is set."""
         logging.error(error)
 
+    def log_warning(self, error: Exception) -> None:
+        """Log warning."""
+        logging.warning(error)
+
     def conditionally_raise(self, error: ImageNotFound) -> None:
         """Raise if it is needed."""
 
@@ -47,19 +92,102 @@ class CollectImages:
             return self.cache.get(key)
         return None
 
+    def init_budget(self) -> None:
+        """Initialize deadline, counter of loaded bytes and list of degraded sources."""
+        self.deadline = None if self.time_budget is None else time.monotonic() + self.time_budget
+        self.bytes_loaded = 0
+        self.degraded = []  # type: List[str]
+
+    def get_remaining_time(self) -> Optional[float]:
+        """Get seconds remaining to the deadline. None if there is no deadline."""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def get_requests_timeout(self) -> Union[None, float, Tuple[Optional[float], Optional[float]]]:
+        """Get requests timeout limited by the remaining time."""
+        remaining = self.get_remaining_time()
+        if remaining is None:
+            return self.requests_timeout
+        # Requests does not accept zero timeout.
+        remaining = max(remaining, 0.001)
+        if self.requests_timeout is None:
+            return remaining
+        if isinstance(self.requests_timeout, tuple):
+            connect, read = self.requests_timeout
+            return (remaining if connect is None else min(connect, remaining),
+                    remaining if read is None else min(read, remaining))
+        return min(self.requests_timeout, remaining)
+
+    def check_deadline(self, src: str) -> None:
+        """Raise BudgetExceeded if the deadline passed."""
+        if self.get_remaining_time() == 0:
+            raise BudgetExceeded("Time budget exceeded: {}".format(src))
+
+    def check_bytes_budget(self, src: str, size: int) -> None:
+        """Raise BudgetExceeded if size does not fit into the bytes budget."""
+        if self.bytes_budget is not None and self.bytes_loaded + size > self.bytes_budget:
+            raise BudgetExceeded("Bytes budget exceeded: {}".format(src))
+
+    def use_replacement_file(self, src: str) -> Optional[bytes]:
+        """Get replacement file. If there is any, the source is recorded as degraded."""
+        content = self.get_replacement_file(src)
+        if content is not None:
+            self.degraded.append(src)
+        return content
+
+    def load_file_within_budget(self, src: str) -> bytes:
+        """Load file if the budget allows it, otherwise use the replacement file."""
+        try:
+            self.check_deadline(src)
+            return self.load_file(src)
+        except BudgetExceeded as err:
+            repl_content = self.use_replacement_file(src)
+            if repl_content is None:
+                raise
+            self.log_warning(err)
+            return repl_content
+
+    def read_response(self, url: str, response: requests.Response) -> bytes:
+        """Read content of the response in chunks. Stop when the budget is exhausted."""
+        chunks = []
+        size = 0
+        expired = False
+        for chunk in response.iter_content(CHUNK_SIZE):
+            # The deadline passed before this chunk, so the download is not finished in time.
+            if expired:
+                raise BudgetExceeded("Time budget exceeded: {}".format(url))
+            size += len(chunk)
+            self.check_bytes_budget(url, size)
+            chunks.append(chunk)
+            expired = self.get_remaining_time() == 0
+        return b"".join(chunks)
+
     def load_file_from_url(self, url: str) -> bytes:
         """Load file from url."""
         cached_content = self.cache_get(url)
         if cached_content is not None:
+            self.check_bytes_budget(url, len(cached_content))
+            cached_type = self.cache_get(CONTENT_TYPE_KEY + url)
+            if cached_type:
+                self.content_types[url] = cached_type.decode("ascii", "replace")
+            self.bytes_loaded += len(cached_content)
             return cached_content
         try:
-            req = requests.get(url, timeout=self.requests_timeout)
-            req.raise_for_status()
-            content = req.content
+            with requests.get(url, timeout=self.get_requests_timeout(), stream=True) as req:
+                req.raise_for_status()
+                content = self.read_response(url, req)
             self.cache_set(url, content)
+            if req.headers.get("Content-Type"):
+                self.content_types[url] = req.headers["Content-Type"]
+                self.cache_set(CONTENT_TYPE_KEY + url, req.headers["Content-Type"].encode("ascii", "replace"))
+            self.bytes_loaded += len(content)
         except requests.RequestException as err:
+            if self.get_remaining_time() == 0:
+                # The timeout was limited by the deadline.
+                raise BudgetExceeded("Time budget exceeded: {} ({})".format(url, err)) from err
             self.log_error(err)
-            repl_content = self.get_replacement_file(url)
+            repl_content = self.use_replacement_file(url)
             if repl_content is None:
                 raise ImageNotFound(err)
             content = repl_content
@@ -70,11 +198,14 @@ class CollectImages:
         for root in self.folders_root:
             fullpath = os.path.join(root, path)
             if os.path.isfile(fullpath):
+                self.check_bytes_budget(path, os.path.getsize(fullpath))
                 with open(fullpath, "rb") as handle:
-                    return handle.read()
-        content = self.get_replacement_file(path)
-        if content is not None:
-            return content
+                    content = handle.read()
+                self.bytes_loaded += len(content)
+                return content
+        repl_content = self.use_replacement_file(path)
+        if repl_content is not None:
+            return repl_content
         raise ImageNotFound()
 
     def load_file(self, src: str) -> bytes:
@@ -94,16 +225,27 @@ class CollectImages:
         self.position += 1
         return "img{}".format(self.position)
 
-    def _get_mime_type(self, path: str) -> List[str]:
-        ctype = mimetypes.guess_type(path)[0]
+    def _get_mime_type(self, path: str, content: bytes = b"") -> List[str]:
+        """Get mime type of the source.
+
+        The magic bytes of the content take precedence, then HTTP Content-Type and the extension of the path.
+        Unknown type is application/octet-stream.
+        """
+        ctype = sniff_mime_type(content)
+        if ctype is None:
+            ctype = self.content_types.get(path, "").split(";", 1)[0].strip().lower()
+            if "/" not in ctype or ctype in GENERIC_CONTENT_TYPES:
+                ctype = mimetypes.guess_type(path)[0]
         if ctype is None or "/" not in ctype:
-            return ["", ""]
+            return ["application", "octet-stream"]
         return ctype.split('/', 1)
 
     def collect_images(self, html_body: str, encoding: str = "UTF-8") -> Tuple[str, List[Tuple[str, str, str, bytes]]]:
         """Collect images from html code.
 
         Return html with iamge src=cid and list of tuple with (maintype, subtype, cid, imagebytes).
+        Sources of images not found, replaced or skipped due to the budget are in the list `degraded`.
+        The budget is not reset here, call init_budget() before collecting the next message.
         """
         images = []
         reader = etree.HTMLParser(recover=True, encoding=encoding)
@@ -114,9 +256,14 @@ class CollectImages:
         for image in root.xpath("//img | //input[@type='image']"):
             image_src = image.attrib["src"]
             try:
-                image_content = self.load_file(image_src)
+                image_content = self.load_file_within_budget(image_src)
+            except BudgetExceeded as err:
+                self.log_warning(err)
+                self.degraded.append(image_src)
+                continue
             except ImageNotFound as err:
                 self.log_error(err)
+                self.degraded.append(image_src)
                 self.conditionally_raise(err)
                 continue
             content_hash = hashlib.md5(image_content).digest()
@@ -125,28 +272,37 @@ class CollectImages:
             else:
                 cid = self.get_next_cid()
                 same_content[content_hash] = cid
-                maintype, subtype = self._get_mime_type(image_src)
+                maintype, subtype = self._get_mime_type(image_src, image_content)
                 images.append((maintype, subtype, cid, image_content))
             image.attrib["src"] = "cid:{}".format(cid)
         html_content = etree.tostring(root, encoding=encoding, pretty_print=self.pretty_print)
         return html_content.decode(encoding), images
 
     def collect_attachments(self, paths_or_urls: Iterable[str]) -> List[Tuple[str, str, str, bytes]]:
-        """Collect attachment contents from paths or urls."""
+        """Collect attachment contents from paths or urls.
+
+        Sources not found, replaced or skipped due to the budget are in the list `degraded`.
+        The budget is not reset here, call init_budget() before collecting the next message.
+        """
         attachments = []
         same_content = []  # type: List[bytes]
         for src in paths_or_urls:
             try:
-                content = self.load_file(src)
+                content = self.load_file_within_budget(src)
+            except BudgetExceeded as err:
+                self.log_warning(err)
+                self.degraded.append(src)
+                continue
             except ImageNotFound as err:
                 self.log_error(err)
+                self.degraded.append(src)
                 self.conditionally_raise(err)
                 continue
             content_hash = hashlib.md5(content).digest()
             if content_hash in same_content:
                 continue
             same_content.append(content_hash)
-            maintype, subtype = self._get_mime_type(src)
+            maintype, subtype = self._get_mime_type(src, content)
             filename = os.path.basename(src)
             attachments.append((maintype, subtype, filename, content))
         return attachments
@@ -8,6 +8,15 @@ from .collect import CollectImages
 COMMASPACE = ', '
 
 
+class MailMessage(EmailMessage):
+    """Email message with the list of sources that were not embedded as they are."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Images and attachments not found, replaced or skipped due to the budget.
+        self.degraded = []  # type: List[str]
+
+
 def create_mail(
         subject: str,
         text_body: str,
@@ -22,9 +31,11 @@ def create_mail(
         cache=None,  # An instance of class with functions cache.get(key) and cache.set(key, value).
         folders_root: List[str] = None,
         requests_timeout: Union[int, Tuple[int, int]] = None,
-        encoding: str = "UTF-8"):
+        encoding: str = "UTF-8",
+        time_budget: float = None,  # Total seconds for loading of all images and attachments.
+        bytes_budget: int = None):  # Total bytes of all loaded images and attachments.
     """Create email object."""
-    msg = EmailMessage()
+    msg = MailMessage()
     msg['Subject'] = subject
     msg['From'] = from_email
     msg['To'] = COMMASPACE.join([str(item) for item in recievers])
@@ -39,7 +50,7 @@ def create_mail(
             msg[name] = value
 
     files_cache = TemporaryFolderCache() if cache is None else cache
-    collector = CollectImages(files_cache, folders_root, requests_timeout)
+    collector = CollectImages(files_cache, folders_root, requests_timeout, time_budget, bytes_budget)
 
     msg.set_content(text_body, charset=encoding)
     if html_message:
@@ -55,4 +66,6 @@ def create_mail(
         for item in collector.collect_attachments(attachments):
             maintype, subtype, filename, content = item
             msg.add_attachment(content, maintype=maintype, subtype=subtype, filename=filename)
+
+    msg.degraded = collector.degraded
     return msg
@@ -1,12 +1,13 @@
 import os
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
+import requests
 import requests_mock
 from pyfakefs.fake_filesystem_unittest import TestCase as FakeFsTestCase
 
 from email_embed_images.cache import TemporaryFolderCache
-from email_embed_images.collect import CollectImages, ImageNotFound
+from email_embed_images.collect import BudgetExceeded, CollectImages, ImageNotFound, sniff_mime_type
 
 
 class TestCollectImagesCacheAndLoadFile(FakeFsTestCase):
@@ -57,6 +58,7 @@ class TestCollectImagesCacheAndLoadFile(FakeFsTestCase):
         collector = WithDefaultImage()
         content = collector.load_file_from_folders("foo.txt")
         self.assertEqual(content, b"ok")
+        self.assertEqual(collector.degraded, ["foo.txt"])
 
     @requests_mock.Mocker()
     def test_load_file_from_internet(self, mock_req):
@@ -128,7 +130,114 @@ class TestCollectImagesCacheAndLoadFile(FakeFsTestCase):
             handle.write("FOO")
         collector = CollectImages()
         attachs = collector.collect_attachments(('unknown.foo', ))
-        self.assertEqual(attachs, [('', '', 'unknown.foo', b'FOO')])
+        self.assertEqual(attachs, [('application', 'octet-stream', 'unknown.foo', b'FOO')])
+
+    @requests_mock.Mocker()
+    def test_collect_images_mime_type_without_extension(self, mock_req):
+        mock_req.get("https://cdn.example.com/img?id=1", content=b"\x89PNG\r\n\x1a\n...")
+        mock_req.get("https://cdn.example.com/img?id=2", content=b"...", headers={"Content-Type": "image/gif"})
+        html = """<img src="https://cdn.example.com/img?id=1"><img src="https://cdn.example.com/img?id=2">"""
+        collector = CollectImages()
+        body, images = collector.collect_images(html)
+        self.assertEqual(images, [
+            ('image', 'png', 'img1', b'\x89PNG\r\n\x1a\n...'),
+            ('image', 'gif', 'img2', b'...'),
+        ])
+
+    @patch("email_embed_images.collect.logging")
+    def test_collect_images_bytes_budget(self, mock_logging):
+        class RaiseNotFound(CollectImages):
+            def conditionally_raise(self, error):
+                raise error
+        with open("img-1.png", "w") as handle:
+            handle.write("PNG-1")
+        with open("img-2.png", "w") as handle:
+            handle.write("PNG-2")
+        html = """<img src="img-1.png"><img src="img-2.png">"""
+        collector = RaiseNotFound(bytes_budget=8)
+        body, images = collector.collect_images(html)
+        self.assertEqual(body, """<html><body><img src="cid:img1"/><img src="img-2.png"/></body></html>""")
+        self.assertEqual(images, [('image', 'png', 'img1', b'PNG-1')])
+        self.assertEqual(collector.bytes_loaded, 5)
+        self.assertEqual(collector.degraded, ["img-2.png"])
+        self.assertTrue(mock_logging.warning.called)
+        self.assertFalse(mock_logging.error.called)
+
+    @patch("email_embed_images.collect.logging")
+    @patch("email_embed_images.collect.time.monotonic")
+    def test_collect_attachments_time_budget(self, mock_monotonic, mock_logging):
+        class WithDefaultImage(CollectImages):
+            def get_replacement_file(self, path):
+                return b"DEFAULT"
+
+            def load_file_from_folders(self, path):
+                content = super().load_file_from_folders(path)
+                mock_monotonic.return_value += 3
+                return content
+        with open("picture.png", "w") as handle:
+            handle.write("PNG")
+        with open("picture.gif", "w") as handle:
+            handle.write("GIF")
+        mock_monotonic.return_value = 100
+        collector = WithDefaultImage(time_budget=2)
+        attachs = collector.collect_attachments(("picture.png", "picture.gif"))
+        self.assertEqual(attachs, [
+            ('image', 'png', 'picture.png', b'PNG'),
+            ('image', 'gif', 'picture.gif', b'DEFAULT'),
+        ])
+        self.assertEqual(collector.degraded, ["picture.gif"])
+        self.assertTrue(mock_logging.warning.called)
+
+    def test_load_file_from_folders_bytes_budget(self):
+        with open("big.png", "w") as handle:
+            handle.write("x" * 10)
+        collector = CollectImages(bytes_budget=5)
+        with patch("email_embed_images.collect.open", create=True) as mock_open:
+            with self.assertRaisesRegex(BudgetExceeded, "Bytes budget exceeded: big.png"):
+                collector.load_file_from_folders("big.png")
+        mock_open.assert_not_called()
+        self.assertEqual(collector.bytes_loaded, 0)
+
+    def test_load_file_from_folders_counts_bytes(self):
+        with open("picture.png", "w") as handle:
+            handle.write("PNG")
+        collector = CollectImages(bytes_budget=5)
+        self.assertEqual(collector.load_file_from_folders("picture.png"), b"PNG")
+        self.assertEqual(collector.bytes_loaded, 3)
+
+    def test_load_file_from_url_from_cache_bytes_budget(self):
+        cache = TemporaryFolderCache()
+        cache.set("https://example.com/path/picture.png", b'PNG')
+        collector = CollectImages(cache=cache, bytes_budget=2)
+        with self.assertRaisesRegex(BudgetExceeded, "Bytes budget exceeded"):
+            collector.load_file_from_url("https://example.com/path/picture.png")
+        collector = CollectImages(cache=cache, bytes_budget=3)
+        self.assertEqual(collector.load_file_from_url("https://example.com/path/picture.png"), b'PNG')
+        self.assertEqual(collector.bytes_loaded, 3)
+
+    @patch("email_embed_images.collect.time.monotonic")
+    def test_collect_attachments_reused_collector(self, mock_monotonic):
+        with open("picture.png", "w") as handle:
+            handle.write("PNG")
+        mock_monotonic.return_value = 100
+        collector = CollectImages(time_budget=2)
+        collector.degraded.append("previous.png")
+        mock_monotonic.return_value = 110
+        collector.init_budget()
+        attachs = collector.collect_attachments(("picture.png", ))
+        self.assertEqual(attachs, [('image', 'png', 'picture.png', b'PNG')])
+        self.assertEqual(collector.degraded, [])
+
+    @requests_mock.Mocker()
+    def test_collect_images_content_type_from_cache(self, mock_req):
+        mock_req.get("https://cdn.example.com/img?id=2", content=b"...", headers={"Content-Type": "image/gif"})
+        html = """<img src="https://cdn.example.com/img?id=2">"""
+        cache = TemporaryFolderCache()
+        for collector in (CollectImages(cache=cache), CollectImages(cache=cache)):
+            body, images = collector.collect_images(html)
+            self.assertEqual(images, [('image', 'gif', 'img1', b'...')])
+        self.assertEqual(mock_req.call_count, 1)
+        self.assertEqual(cache.get("content-type:https://cdn.example.com/img?id=2"), b"image/gif")
 
     def test_load_file_from_url_from_cache(self):
         cache = TemporaryFolderCache()
@@ -146,6 +255,12 @@ class TestCollectImages(TestCase):
         collector.log_error(ImageNotFound())
         self.assertTrue(mock_logging.error.called)
 
+    @patch("email_embed_images.collect.logging")
+    def test_log_warning(self, mock_logging):
+        collector = CollectImages()
+        collector.log_warning(BudgetExceeded())
+        self.assertTrue(mock_logging.warning.called)
+
     def test_conditionally_raise(self):
         class MyClass(CollectImages):
             def conditionally_raise(self, error):
@@ -188,8 +303,229 @@ class TestCollectImages(TestCase):
         collector = WithDefaultImage()
         content = collector.load_file_from_url("https://foo.foo/none")
         self.assertEqual(content, b'ok')
+        self.assertEqual(collector.degraded, ["https://foo.foo/none"])
         self.assertTrue(mock_logging.error.called)
 
+    @requests_mock.Mocker()
+    @patch("email_embed_images.collect.logging")
+    def test_load_file_from_url_timeout(self, mock_req, mock_logging):
+        mock_req.get("https://foo.foo/slow", exc=requests.exceptions.ReadTimeout)
+        collector = CollectImages(time_budget=5)
+        body, images = collector.collect_images("""<img src="https://foo.foo/slow">""")
+        self.assertEqual(body, """<html><body><img src="https://foo.foo/slow"/></body></html>""")
+        self.assertEqual(images, [])
+        self.assertEqual(collector.degraded, ["https://foo.foo/slow"])
+        self.assertTrue(mock_logging.error.called)
+
+    @requests_mock.Mocker()
+    def test_load_file_from_url_stops_over_bytes_budget(self, mock_req):
+        mock_req.get("https://foo.foo/big", content=b"x" * 10)
+        cache = MagicMock(get=MagicMock(return_value=None))
+        collector = CollectImages(cache=cache, bytes_budget=5)
+        with patch("email_embed_images.collect.CHUNK_SIZE", 2):
+            with self.assertRaisesRegex(BudgetExceeded, "Bytes budget exceeded: https://foo.foo/big"):
+                collector.load_file_from_url("https://foo.foo/big")
+        cache.set.assert_not_called()
+        self.assertEqual(collector.bytes_loaded, 0)
+
+    @requests_mock.Mocker()
+    @patch("email_embed_images.collect.time.monotonic")
+    def test_load_file_from_url_stops_at_deadline(self, mock_req, mock_monotonic):
+        mock_req.get("https://foo.foo/slow", content=b"x" * 10)
+        mock_req.get("https://foo.foo/last", content=b"xx")
+        mock_monotonic.return_value = 100
+        collector = CollectImages(time_budget=5)
+        mock_monotonic.return_value = 105
+        with patch("email_embed_images.collect.CHUNK_SIZE", 2):
+            with self.assertRaisesRegex(BudgetExceeded, "Time budget exceeded: https://foo.foo/slow"):
+                collector.load_file_from_url("https://foo.foo/slow")
+            # The last chunk finished the download, so the content is kept.
+            self.assertEqual(collector.load_file_from_url("https://foo.foo/last"), b"xx")
+
+    @requests_mock.Mocker()
+    @patch("email_embed_images.collect.logging")
+    @patch("email_embed_images.collect.time.monotonic")
+    def test_load_file_from_url_timeout_at_deadline(self, mock_req, mock_monotonic, mock_logging):
+        class WithDefaultImage(CollectImages):
+            def get_replacement_file(self, path):
+                return b"DEFAULT"
+
+        def timeout(request, context):
+            mock_monotonic.return_value = 105
+            raise requests.exceptions.ReadTimeout
+
+        mock_req.get("https://foo.foo/slow", text=timeout)
+        mock_monotonic.return_value = 100
+        collector = WithDefaultImage(time_budget=5)
+        with patch.object(collector, "get_replacement_file", wraps=collector.get_replacement_file) as mock_repl:
+            body, images = collector.collect_images("""<img src="https://foo.foo/slow">""")
+        self.assertEqual(images, [('application', 'octet-stream', 'img1', b'DEFAULT')])
+        self.assertEqual(collector.degraded, ["https://foo.foo/slow"])
+        mock_repl.assert_called_once_with("https://foo.foo/slow")
+        self.assertTrue(mock_logging.warning.called)
+        self.assertFalse(mock_logging.error.called)
+
+    @requests_mock.Mocker()
+    @patch("email_embed_images.collect.logging")
+    @patch("email_embed_images.collect.time.monotonic")
+    def test_load_file_from_url_timeout_at_deadline_no_raise(self, mock_req, mock_monotonic, mock_logging):
+        class RaiseNotFound(CollectImages):
+            def conditionally_raise(self, error):
+                raise error
+
+        def timeout(request, context):
+            mock_monotonic.return_value = 101
+            raise requests.exceptions.ReadTimeout
+
+        mock_req.get("https://foo.foo/slow", text=timeout)
+        mock_monotonic.return_value = 100
+        collector = RaiseNotFound(time_budget=1)
+        body, images = collector.collect_images("""<img src="https://foo.foo/slow">""")
+        self.assertEqual(body, """<html><body><img src="https://foo.foo/slow"/></body></html>""")
+        self.assertEqual(collector.degraded, ["https://foo.foo/slow"])
+        self.assertTrue(mock_logging.warning.called)
+
+    @requests_mock.Mocker()
+    @patch("email_embed_images.collect.logging")
+    def test_load_file_from_url_replacement_over_bytes_budget(self, mock_req, mock_logging):
+        class WithDefaultImage(CollectImages):
+            def get_replacement_file(self, path):
+                return b"DEFAULT"
+        mock_req.get("https://foo.foo/none", text='Not Found', status_code=404)
+        collector = WithDefaultImage(bytes_budget=2)
+        content = collector.load_file_within_budget("https://foo.foo/none")
+        self.assertEqual(content, b"DEFAULT")
+        self.assertEqual(collector.degraded, ["https://foo.foo/none"])
+        self.assertEqual(collector.bytes_loaded, 0)
+
+    @requests_mock.Mocker()
+    def test_load_file_from_url_content_type(self, mock_req):
+        mock_req.get("https://example.com/file", text='PNG', headers={"Content-Type": "image/png"})
+        collector = CollectImages()
+        collector.load_file_from_url("https://example.com/file")
+        self.assertEqual(collector.content_types, {"https://example.com/file": "image/png"})
+
+    def test_sniff_mime_type(self):
+        self.assertEqual(sniff_mime_type(b"\x89PNG\r\n\x1a\n..."), "image/png")
+        self.assertEqual(sniff_mime_type(b"\xff\xd8\xff\xe0..."), "image/jpeg")
+        self.assertEqual(sniff_mime_type(b"GIF87a..."), "image/gif")
+        self.assertEqual(sniff_mime_type(b"GIF89a..."), "image/gif")
+        self.assertEqual(sniff_mime_type(b"RIFF\x00\x00\x00\x00WEBPVP8 "), "image/webp")
+        self.assertEqual(sniff_mime_type(b"RIFF\x00\x00\x00\x00WAVEfmt "), None)
+        self.assertEqual(sniff_mime_type(b"%PDF-1.4"), "application/pdf")
+        self.assertEqual(sniff_mime_type(b"  <svg xmlns='http://www.w3.org/2000/svg'>"), "image/svg+xml")
+        self.assertEqual(sniff_mime_type(b"<?xml version='1.0'?>\n<svg>"), "image/svg+xml")
+        self.assertEqual(sniff_mime_type(b"<?xml version='1.0'?>\n<note>"), None)
+        self.assertEqual(sniff_mime_type(b"PNG"), None)
+
+    def test_get_mime_type(self):
+        collector = CollectImages()
+        self.assertEqual(collector._get_mime_type("picture.jpg", b"GIF89a..."), ["image", "gif"])
+        self.assertEqual(collector._get_mime_type("picture.png", b"PNG"), ["image", "png"])
+        self.assertEqual(collector._get_mime_type("unknown.foo", b"FOO"), ["application", "octet-stream"])
+
+    def test_get_mime_type_content_type(self):
+        collector = CollectImages()
+        collector.content_types["https://example.com/a"] = "Image/JPEG; charset=binary"
+        collector.content_types["https://example.com/b.png"] = "application/octet-stream"
+        self.assertEqual(collector._get_mime_type("https://example.com/a", b"..."), ["image", "jpeg"])
+        self.assertEqual(collector._get_mime_type("https://example.com/b.png", b"..."), ["image", "png"])
+
+    def test_get_mime_type_by_content(self):
+        collector = CollectImages()
+        self.assertEqual(collector._get_mime_type("picture", b"GIF89a..."), ["image", "gif"])
+        self.assertEqual(collector._get_mime_type("picture", b"\x89PNG\r\n\x1a\n..."), ["image", "png"])
+
+    @patch("email_embed_images.collect.time.monotonic")
+    def test_init_budget(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        collector = CollectImages(time_budget=5)
+        collector.bytes_loaded = 42
+        collector.degraded.append("foo")
+        collector.init_budget()
+        self.assertEqual(collector.deadline, 105)
+        self.assertEqual(collector.bytes_loaded, 0)
+        self.assertEqual(collector.degraded, [])
+
+    @patch("email_embed_images.collect.time.monotonic")
+    def test_get_remaining_time(self, mock_monotonic):
+        self.assertIsNone(CollectImages().get_remaining_time())
+        mock_monotonic.return_value = 100
+        collector = CollectImages(time_budget=5)
+        mock_monotonic.return_value = 102
+        self.assertEqual(collector.get_remaining_time(), 3)
+        mock_monotonic.return_value = 106
+        self.assertEqual(collector.get_remaining_time(), 0)
+
+    @patch("email_embed_images.collect.time.monotonic")
+    def test_get_requests_timeout(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        self.assertIsNone(CollectImages().get_requests_timeout())
+        self.assertEqual(CollectImages(requests_timeout=7).get_requests_timeout(), 7)
+        self.assertEqual(CollectImages(time_budget=5).get_requests_timeout(), 5)
+        self.assertEqual(CollectImages(requests_timeout=7, time_budget=5).get_requests_timeout(), 5)
+        self.assertEqual(CollectImages(requests_timeout=3, time_budget=5).get_requests_timeout(), 3)
+        self.assertEqual(CollectImages(requests_timeout=(3, 7), time_budget=5).get_requests_timeout(), (3, 5))
+        self.assertEqual(CollectImages(requests_timeout=(None, 3), time_budget=5).get_requests_timeout(), (5, 3))
+        self.assertEqual(CollectImages(requests_timeout=(3, None), time_budget=5).get_requests_timeout(), (3, 5))
+        collector = CollectImages(time_budget=5)
+        mock_monotonic.return_value = 110
+        self.assertEqual(collector.get_requests_timeout(), 0.001)
+
+    @requests_mock.Mocker()
+    @patch("email_embed_images.collect.time.monotonic")
+    def test_load_file_within_budget(self, mock_req, mock_monotonic):
+        mock_req.get("https://example.com/file.png", text='PNG')
+        mock_monotonic.return_value = 100
+        collector = CollectImages(time_budget=5, bytes_budget=3)
+        content = collector.load_file_within_budget("https://example.com/file.png")
+        self.assertEqual(content, b"PNG")
+        self.assertEqual(mock_req.last_request.timeout, 5)
+        self.assertEqual(collector.bytes_loaded, 3)
+        self.assertEqual(collector.degraded, [])
+
+    @patch("email_embed_images.collect.time.monotonic")
+    def test_load_file_within_budget_deadline(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        collector = CollectImages(time_budget=5)
+        mock_monotonic.return_value = 105
+        with patch.object(collector, "load_file") as mock_load_file:
+            with self.assertRaisesRegex(BudgetExceeded, "Time budget exceeded: https://example.com/file.png"):
+                collector.load_file_within_budget("https://example.com/file.png")
+        mock_load_file.assert_not_called()
+        self.assertEqual(collector.degraded, [])
+
+    @patch("email_embed_images.collect.logging")
+    def test_load_file_within_budget_replacement(self, mock_logging):
+        class WithDefaultImage(CollectImages):
+            def get_replacement_file(self, path):
+                return b"ok"
+        collector = WithDefaultImage(bytes_budget=0)
+        with patch.object(collector, "load_file", side_effect=BudgetExceeded("Bytes budget exceeded: file.png")):
+            content = collector.load_file_within_budget("file.png")
+        self.assertEqual(content, b"ok")
+        self.assertEqual(collector.bytes_loaded, 0)
+        self.assertEqual(collector.degraded, ["file.png"])
+        self.assertTrue(mock_logging.warning.called)
+
+    def test_check_bytes_budget(self):
+        collector = CollectImages(bytes_budget=5)
+        collector.check_bytes_budget("file.png", 5)
+        collector.bytes_loaded = 3
+        with self.assertRaisesRegex(BudgetExceeded, "Bytes budget exceeded: file.png"):
+            collector.check_bytes_budget("file.png", 3)
+        CollectImages().check_bytes_budget("file.png", 1000)
+
+    @patch("email_embed_images.collect.time.monotonic")
+    def test_check_deadline(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        collector = CollectImages(time_budget=5)
+        collector.check_deadline("file.png")
+        CollectImages().check_deadline("file.png")
+        mock_monotonic.return_value = 105
+        with self.assertRaisesRegex(BudgetExceeded, "Time budget exceeded: file.png"):
+            collector.check_deadline("file.png")
+
     def test_init_cid(self):
         collector = CollectImages()
         collector.init_cid()
@@ -41,6 +41,7 @@ class TestCreateMail(FakeFsTestCase):
         self.assertEqual(mail.get("cc"), "cc1@foo.foo, cc2@foo.foo")
         self.assertEqual(mail.get("bcc"), "bcc1@foo.foo")
         self.assertEqual(mail.get("reply-to"), "reply-to@foo.foo")
+        self.assertEqual(mail.degraded, [])
 
         part_alt, attachment_pdf, attachment_log = mail.get_payload()
         part_text, part_related = part_alt.get_payload()
@@ -59,3 +60,20 @@ class TestCreateMail(FakeFsTestCase):
         self.assertEqual(attachment_pdf.get('content-disposition'), 'attachment; filename="example.pdf"')
         self.assertEqual(attachment_log.get('content-type'), 'text/plain')
         self.assertEqual(attachment_log.get('content-disposition'), 'attachment; filename="chengelog.txt"')
+
+    def test_create_mail_bytes_budget(self):
+        with open("picture.png", "w") as handle:
+            handle.write("PNG")
+        with open("icon.gif", "w") as handle:
+            handle.write("GIF")
+        with open("example.pdf", "w") as handle:
+            handle.write("PDF")
+        html_message = """<img src="picture.png"><img src="icon.gif">"""
+        mail = create_mail("Test mail", "Mail text body.", "sender@foo.foo", ["recipient@foo.foo"],
+                           html_message=html_message, attachments=("example.pdf", "missing.txt"), bytes_budget=6)
+        self.assertEqual(mail.degraded, ["example.pdf", "missing.txt"])
+        self.assertEqual(mail.get_content_type(), 'multipart/alternative')
+        part_text, part_related = mail.get_payload()
+        part_html, part_png, part_gif = part_related.get_payload()
+        self.assertEqual(part_png.get('content-id'), 'img1')
+        self.assertEqual(part_gif.get('content-id'), 'img2')